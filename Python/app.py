@@ -1,17 +1,146 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, send_from_directory
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from data_handler import handler
 import threading  # LÍNEA AGREGADA: Permite el uso de hilos para procesos de fondo
 import logging
+import os
+import io
+import re
+import time
+import random
+import hmac
+import cProfile
+import pstats
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Configuración de logs para ver el flujo en la terminal
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
 logger = logging.getLogger("CerebroServer")
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Serialización JSON con orjson para los listados grandes de prospectos."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS), mimetype=self.mimetype)
+
 app = Flask(__name__)
+# Proveedor JSON configurable: JSON_PROVIDER=orjson (por defecto si está instalado) o JSON_PROVIDER=std
+if orjson is not None and (os.getenv("JSON_PROVIDER") or "orjson").lower() == "orjson":
+    app.json = OrjsonProvider(app)
 # Configuración CORS global para permitir la comunicación con los archivos HTML
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
+# --- PERFILADO BAJO DEMANDA ---
+# Se activa por petición con el header X-Profile-Token (igual a PROFILE_TOKEN) o por muestreo con PROFILE_SAMPLE_RATE (0.0 - 1.0).
+def _leer_numero_env(nombre, defecto, tipo):
+    # Un valor inválido no debe impedir que arranque la app: se usa el valor por defecto
+    try: return tipo(os.getenv(nombre) or defecto)
+    except ValueError:
+        logger.warning(f"PERFIL: {nombre} inválido, se usa {defecto}.")
+        return defecto
+
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN") or ""
+PROFILE_SAMPLE_RATE = min(max(_leer_numero_env("PROFILE_SAMPLE_RATE", 0.0, float), 0.0), 1.0)
+PROFILE_DIR = os.getenv("PROFILE_DIR") or "/tmp/cerebro_profiles"
+PROFILE_MAX_FILES = max(_leer_numero_env("PROFILE_MAX_FILES", 50, int), 1)
+PROFILE_ACTIVO = bool(PROFILE_TOKEN) or PROFILE_SAMPLE_RATE > 0
+
+def _perfil_autorizado():
+    # Comparación en tiempo constante para no filtrar el token por tiempos de respuesta
+    return bool(PROFILE_TOKEN) and hmac.compare_digest(request.headers.get('X-Profile-Token', '').encode('utf-8'), PROFILE_TOKEN.encode('utf-8'))
+
+@app.before_request
+def iniciar_perfilado():
+    if not PROFILE_ACTIVO or request.method == 'OPTIONS' or request.path.startswith('/api/profiles'): return
+    if not _perfil_autorizado() and random.random() >= PROFILE_SAMPLE_RATE: return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Otro hilo ya está perfilando (solo se admite un perfilador activo a la vez)
+        return
+    g.profiler = profiler
+    g.profile_inicio = time.time()
+
+@app.after_request
+def guardar_perfilado(response):
+    profiler = g.pop('profiler', None)
+    if profiler is None: return response
+    profiler.disable()
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        duracion_ms = int((time.time() - g.pop('profile_inicio')) * 1000)
+        ruta = re.sub(r'[^a-zA-Z0-9]+', '-', request.path).strip('-')
+        nombre = f"{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}_{ruta}_{duracion_ms}ms.prof"
+        profiler.dump_stats(os.path.join(PROFILE_DIR, nombre))
+        # Directorio acotado: se conservan solo los PROFILE_MAX_FILES más recientes
+        archivos = sorted((f for f in os.listdir(PROFILE_DIR) if f.endswith('.prof')), key=lambda f: os.path.getmtime(os.path.join(PROFILE_DIR, f)))
+        for viejo in archivos[:-PROFILE_MAX_FILES]:
+            os.remove(os.path.join(PROFILE_DIR, viejo))
+        logger.info(f"PERFIL: {request.path} -> {nombre}")
+    except Exception as e:
+        logger.error(f"PERFIL ERROR: {e}")
+    return response
+
+@app.teardown_request
+def cerrar_perfilado(exc):
+    # Si la petición terminó con excepción no se llega a after_request; se libera el perfilador
+    profiler = g.pop('profiler', None)
+    if profiler is not None: profiler.disable()
+
+def _esquema_compacto():
+    esquema = request.args.get('schema') or request.headers.get('X-Schema') or ''
+    return esquema.lower() == 'compact'
+
+def _prospectos_json(data):
+    """
+    Con ?schema=compact (o header X-Schema: compact) se devuelve el esquema compacto de prospectos.
+    Sin el flag se conserva el formato legado que usan los frontends actuales.
+    """
+    if not _esquema_compacto() or data is None: return jsonify(data)
+    if isinstance(data, list): return jsonify([handler.compactar_prospecto(p) for p in data])
+    return jsonify(handler.compactar_prospecto(data))
+
+def _expediente_respuesta(p_id):
+    """Expediente actualizado con el esquema pedido por el cliente (legado o ?schema=compact)."""
+    perfil = handler.get_client_full_profile(p_id)
+    if perfil and _esquema_compacto(): perfil = handler.compactar_prospecto(perfil)
+    return perfil
+
+def _reservar_sync(sync_id):
+    """
+    Reserva el syncId antes de procesar para que /api/sync-batch no ejecute el mismo elemento en paralelo.
+    Retorna el resultado previo si ya se procesó (o está en curso). Si el almacén no responde se procesa igual.
+    """
+    if not sync_id: return None
+    try: return handler.idempotencia.reservar(sync_id)
+    except Exception as e:
+        logger.error(f"IDEMPOTENCIA ERROR: No se pudo reservar {sync_id} -> {e}")
+        return None
+
+def _cerrar_sync(sync_id, resultado):
+    """Guarda el resultado definitivo (success/duplicate) o libera la reserva para permitir el reintento."""
+    if not sync_id: return
+    try:
+        if resultado and resultado.get('status') in ['success', 'duplicate']:
+            handler.idempotencia.guardar(sync_id, {k: v for k, v in resultado.items() if k not in ['p_id', 'num_seg', 'data']})
+        else:
+            handler.idempotencia.liberar(sync_id)
+    except Exception as e:
+        logger.error(f"IDEMPOTENCIA ERROR: No se registró el resultado de {sync_id} -> {e}")
+
 def background_sync(action_type, data):
     """
     Función que se ejecuta en un hilo separado.
@@ -97,13 +226,25 @@ def get_my_calendar():
 @app.route('/api/update-client-advanced', methods=['POST', 'OPTIONS'])
 def update_client_advanced():
     if request.method == 'OPTIONS': return jsonify({"status": "ok"}), 200
+    reservado = None  # syncId reservado por esta petición y aún sin resultado definitivo
     try:
         data = request.json
         p_id = data.get('p_id')
         if not p_id: return jsonify({"status": "error", "message": "Se requiere el identificador único (p_id)."}), 400
         
+        sync_id = data.get('sync_id')
+        previo = _reservar_sync(sync_id)
+        if previo is not None:
+            # Ya procesado (o en curso) por otra petición con el mismo syncId
+            if previo.get('status') != 'success': return jsonify(previo), 202
+            previo['data'] = _expediente_respuesta(p_id)
+            return jsonify(previo)
+        reservado = sync_id
+        
         # Llamamos al handler para guardar en Supabase de forma INMEDIATA y SÍNCRONA
         res = handler.actualizar_prospecto_avanzado(p_id, data.get('updates'))
+        _cerrar_sync(sync_id, res)
+        reservado = None
         
         # Si guardó correctamente en base de datos y venían archivos, los subimos a Drive en un hilo asíncrono
         if res.get('status') == 'success' and data.get('files_payload'):
@@ -120,17 +261,24 @@ def update_client_advanced():
             res.pop('num_seg', None)
 
         # Retornamos el success inmediatamente al frontend para liberar el socket en macOS
-        updated_data = handler.get_client_full_profile(p_id)
-        res['data'] = updated_data
+        res['data'] = _expediente_respuesta(p_id)
         return jsonify(res)
-    except Exception as e: return jsonify({"status": "error", "message": str(e)}), 500
+    except Exception as e:
+        # Solo se libera una reserva propia sin cerrar; un success ya guardado no se toca
+        _cerrar_sync(reservado, None)
+        return jsonify({"status": "error", "message": str(e)}), 500
 
 @app.route('/api/client-details', methods=['GET'])
 def get_client_details():
+    # Modo lote: ?ids=1,2,3 devuelve la lista de expedientes en una sola consulta
+    ids = request.args.get('ids')
+    if ids:
+        id_list = [i.strip() for i in ids.split(',') if i.strip()]
+        return _prospectos_json(handler.get_clients_full_profiles(id_list))
     p_id = request.args.get('id')
     if not p_id: return jsonify({"status":"error"}), 400
     data = handler.get_client_full_profile(p_id)
-    return jsonify(data)
+    return _prospectos_json(data)
 
 
 @app.route('/api/delete-client', methods=['POST', 'OPTIONS'])
@@ -142,6 +290,17 @@ def delete_client():
         return jsonify({"status": "success" if success else "error", "message": message})
     except Exception as e: return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/api/delete-clients', methods=['POST', 'OPTIONS'])
+def delete_clients_bulk():
+    """Borrado masivo por canales ({canales: [...], auditor}); la limpieza de Drive queda en segundo plano."""
+    if request.method == 'OPTIONS': return jsonify({"status": "ok"}), 200
+    try:
+        data = request.json or {}
+        res = handler.delete_clients_bulk(data.get('canales'), data.get('auditor'))
+        # 'partial': parte de los lotes se borró; la respuesta indica cuáles canales reintentar
+        return jsonify(res), 200 if res.get('status') in ['success', 'partial'] else 400
+    except Exception as e: return jsonify({"status": "error", "message": str(e)}), 500
+
 @app.route('/api/add-client', methods=['POST', 'OPTIONS'])
 def add_client():
     """
@@ -153,12 +312,23 @@ def add_client():
     if request.method == 'OPTIONS':
         return jsonify({"status": "ok"}), 200
         
+    reservado = None  # syncId reservado por esta petición y aún sin resultado definitivo
     try:
         data = request.json
         
+        # Se reserva el syncId para que /api/sync-batch no procese el mismo elemento a la vez
+        sync_id = data.get('sync_id')
+        previo = _reservar_sync(sync_id)
+        if previo is not None:
+            codigos = {"duplicate": 409, "success": 201}
+            return jsonify(previo), codigos.get(previo.get('status'), 202)
+        reservado = sync_id
+        
         # El handler realiza la verificación preventiva de duplicados y subida a Drive
         result = handler.registrar_prospecto(data)
-        
+        _cerrar_sync(sync_id, result)
+        reservado = None
+
         # Si es duplicado, el handler devuelve status 'duplicate'
         if result.get('status') == 'duplicate':
             logger.info(f"API: Duplicado detectado para {data.get('Canal')}. Operación abortada.")
@@ -178,13 +348,52 @@ def add_client():
         return jsonify(result), 400
         
     except Exception as e:
+        _cerrar_sync(reservado, None)
         logger.error(f"Error crítico en add-client: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/api/sync-batch', methods=['POST', 'OPTIONS'])
+def sync_batch():
+    """
+    Recibe la cola offline completa del frontend ({items: [{syncId, endpoint, payload}]}).
+    Deduplica por syncId, procesa altas y actualizaciones por lotes y devuelve el resultado por elemento.
+    """
+    if request.method == 'OPTIONS': return jsonify({"status": "ok"}), 200
+    try:
+        data = request.json or {}
+        items = data.get('items') or []
+        resultados = handler.sincronizar_lote(items)
+        
+        # Mismos procesos de fondo que los endpoints individuales, solo para lo recién procesado
+        for item, res in zip(items, resultados):
+            if res.get('replay') or res.get('status') != 'success': continue
+            payload = item.get('payload') or {}
+            if handler._tipo_sync(item) == 'alta':
+                threading.Thread(target=background_sync, args=("ADD", payload)).start()
+                # Las altas del lote se insertan sin evidencia; se sube aquí para no bloquear el worker
+                if payload.get('files_payload') and res.get('p_id'):
+                    threading.Thread(
+                        target=handler.subir_evidencia_fondo,
+                        args=(payload.get('Nombre'), payload.get('files_payload'), None, res.get('p_id'), "Registro")
+                    ).start()
+            elif payload.get('files_payload'):
+                threading.Thread(
+                    target=handler.subir_evidencia_fondo,
+                    args=(payload.get('nombre_original', 'Desconocido'), payload.get('files_payload'), res.get('num_seg'), res.get('p_id'))
+                ).start()
+            res.pop('p_id', None)
+            res.pop('num_seg', None)
+        
+        logger.info(f"SYNC-BATCH: {len(items)} elementos procesados.")
+        return jsonify({"status": "success", "results": resultados})
+    except Exception as e:
+        logger.error(f"Error crítico en sync-batch: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
 @app.route('/api/clients', methods=['GET'])
 def get_clients_by_agent():
     asesora = request.args.get('asesora')
-    return jsonify(handler.get_clients_for_agent(asesora) if asesora else [])
+    return _prospectos_json(handler.get_clients_for_agent(asesora) if asesora else [])
 
 @app.route('/api/agents', methods=['GET'])
 def get_agents_list():
@@ -192,7 +401,12 @@ def get_agents_list():
 
 @app.route('/api/all-clients', methods=['GET'])
 def get_all_clients():
-    return jsonify(handler.get_all_clients())
+    return _prospectos_json(handler.get_all_clients())
+
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    # Conteos por asesora desde resumen_dashboard (sin transferir la tabla completa)
+    return jsonify(handler.get_stats(request.args.get('asesora')))
 
 @app.route('/api/auditors', methods=['GET'])
 def get_auditors():
@@ -214,9 +428,32 @@ def get_sync_queue(): return jsonify([])
 @app.route('/api/journal-tail', methods=['GET'])
 def get_journal_tail(): return jsonify(["[SISTEMA] Motor v1.10 Activo", "[DB] Sincronización OK"])
 
+@app.route('/api/profiles', methods=['GET'])
+def list_profiles():
+    if not _perfil_autorizado(): return jsonify({"status": "error", "message": "No autorizado."}), 403
+    if not os.path.isdir(PROFILE_DIR): return jsonify([])
+    archivos = sorted((f for f in os.listdir(PROFILE_DIR) if f.endswith('.prof')), key=lambda f: os.path.getmtime(os.path.join(PROFILE_DIR, f)), reverse=True)
+    return jsonify([{"nombre": f, "bytes": os.path.getsize(os.path.join(PROFILE_DIR, f))} for f in archivos])
+
+@app.route('/api/profiles/<nombre>', methods=['GET'])
+def download_profile(nombre):
+    """Descarga el .prof (cProfile/pstats). Con ?formato=texto devuelve el resumen ordenado por tiempo acumulado."""
+    if not _perfil_autorizado(): return jsonify({"status": "error", "message": "No autorizado."}), 403
+    if not nombre.endswith('.prof') or not os.path.isfile(os.path.join(PROFILE_DIR, nombre)):
+        return jsonify({"status": "error", "message": "Perfil no encontrado."}), 404
+    if request.args.get('formato') == 'texto':
+        salida = io.StringIO()
+        pstats.Stats(os.path.join(PROFILE_DIR, nombre), stream=salida).sort_stats('cumulative').print_stats(60)
+        return salida.getvalue(), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+    return send_from_directory(PROFILE_DIR, nombre, as_attachment=True)
+
 # --- INICIO MÓDULO POOL ---
 @app.route('/api/pool', methods=['GET'])
 def get_pool():
+    # Con ?asesora= se sirve desde la cola en memoria (lote exclusivo por asesora)
+    asesora = request.args.get('asesora')
+    if asesora:
+        return jsonify(handler.get_pool_for_agent(asesora))
     return jsonify(handler.get_pool_clients())
 
 @app.route('/api/pool/take', methods=['POST', 'OPTIONS'])
@@ -238,6 +475,10 @@ def resolve_pool():
     if res.get('status') == 'error':
         return jsonify(res), code
     return jsonify(res), 200
+
+@app.route('/api/pool/sweeper-metrics', methods=['GET'])
+def get_pool_sweeper_metrics():
+    return jsonify(handler.get_barrido_metricas())
 # --- FIN MÓDULO POOL ---
 
 if __name__ == '__main__':
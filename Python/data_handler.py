@@ -11,6 +11,9 @@ from dotenv import load_dotenv
 from supabase import create_client, Client
 import re
 import pytz
+import threading
+import time
+from collections import OrderedDict
 # Carga de variables de entorno
 load_dotenv()
 
@@ -22,6 +25,40 @@ logger = logging.getLogger("DataHandler")
 SUPABASE_URL = "https://qldrdljyuqlyqwoauwyd.supabase.co"
 SUPABASE_KEY = os.getenv("SUPABASE_KEY") or ""
 
+# Máximo de expedientes completos que se mantienen en memoria (LRU por p_id)
+PERFIL_CACHE_MAX = 500
+# Vigencia de cada expediente en caché: acota el rendimiento calculado al cambiar de día.
+# Entre workers (Gunicorn) la frescura se valida contra updated_at antes de servir un lote desde caché.
+PERFIL_CACHE_TTL = 60
+
+# --- CONFIGURACIÓN POOL ---
+POOL_COLUMNAS = "folio_i, telefono, status, hora, fecha, updated, updated_at"
+POOL_LISTO_TAMANO = 200      # Libres elegibles que se mantienen listos en memoria
+POOL_LISTO_MINIMO = 50       # Por debajo de este número se dispara un rellenado inmediato
+POOL_LISTO_INTERVALO = 30    # Segundos entre rellenados periódicos
+POOL_LISTO_POR_ASESORA = 10  # Tamaño del lote exclusivo entregado a cada asesora
+POOL_LISTO_RESERVA = 120     # Segundos que un lote entregado queda asignado a su asesora (asignado_hasta)
+POOL_FILTRO_LIBRE = 'status.is.null,status.in.("",NSH,LIBRE)'  # Estados libres, como filtro PostgREST
+BARRIDO_INTERVALO = 300      # Segundos entre barridos de apartados BLOQUEADO_ vencidos
+BARRIDO_DIAS = 6             # Un apartado vence al cumplir 6 días (regla previa: diff.days > 5)
+
+# --- CONFIGURACIÓN SINCRONIZACIÓN OFFLINE ---
+IDEMPOTENCIA_TTL = 24 * 3600   # Segundos que se recuerda un syncId ya procesado
+IDEMPOTENCIA_EN_PROCESO_TTL = 300  # Segundos que dura una reserva en curso (worker caído = se puede reintentar)
+IDEMPOTENCIA_PURGA_INTERVALO = 3600  # Segundos entre purgas de syncId vencidos
+
+# --- CONFIGURACIÓN DASHBOARD ---
+RESUMEN_INTERVALO = 600        # Segundos entre reconciliaciones completas del resumen
+RESUMEN_CAMPOS = ["estado_final", "nivel_interes", "rendimiento"]
+SELECT_ACTUALIZACION = "id, canal, fecha_proxima, estado_final"
+
+# --- CONFIGURACIÓN BORRADO ---
+BORRADO_LOTE = 200             # Canales por cada delete().in_()
+BORRADO_DRIVE_REINTENTOS = 5   # Intentos máximos para borrar una carpeta de Drive
+BORRADO_DRIVE_ESPERA = 30      # Segundos base entre reintentos (crece de forma exponencial)
+BORRADO_DRIVE_SONDEO = 60      # Segundos entre revisiones de lápidas pendientes
+BORRADO_DRIVE_TOMA = 120       # Segundos que una lápida tomada queda reservada para su worker
+
 class GoogleSheetsSync:
     """
     Módulo especializado en la comunicación con Google Sheets y Drive.
@@ -88,6 +125,259 @@ class GoogleSheetsSync:
             return ws.get_all_records()
         except: return []
 
+class AlmacenIdempotencia:
+    """
+    Registro de syncId ya procesados en la tabla sync_idempotencia (sql/sync_idempotencia.sql),
+    compartido por todos los workers, para que los reintentos de la cola offline no repitan
+    el pipeline de Supabase/Drive. Las reservas en curso vencen pronto por si el worker muere.
+    Un hilo de fondo purga periódicamente las filas vencidas (purgar_sync_idempotencia).
+    """
+    EN_PROCESO = {"status": "processing", "message": "Operación en curso."}
+
+    def __init__(self, supabase, ttl=IDEMPOTENCIA_TTL, ttl_en_proceso=IDEMPOTENCIA_EN_PROCESO_TTL):
+        self.supabase = supabase
+        self.ttl = ttl
+        self.ttl_en_proceso = ttl_en_proceso
+        threading.Thread(target=self._ciclo, name="PurgaIdempotencia", daemon=True).start()
+
+    def _ciclo(self):
+        # Se consulta con más frecuencia que el intervalo; la BD decide qué worker purga
+        while True:
+            self.purgar_vencidos()
+            time.sleep(IDEMPOTENCIA_PURGA_INTERVALO / 5)
+
+    def purgar_vencidos(self):
+        try:
+            res = self.supabase.rpc("purgar_sync_idempotencia", {"p_intervalo_seg": IDEMPOTENCIA_PURGA_INTERVALO}).execute()
+            if res.data: logger.info(f"IDEMPOTENCIA: {res.data} syncId vencidos purgados.")
+            return res.data
+        except Exception as e:
+            logger.error(f"IDEMPOTENCIA PURGA ERROR: {e}")
+            return None
+
+    def _vence(self, segundos):
+        return (datetime.utcnow() + timedelta(seconds=segundos)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def reservar_lote(self, sync_ids):
+        """
+        Marca los syncId como en proceso con un insert que ignora existentes.
+        Retorna {sync_id: resultado previo} solo para los que ya estaban registrados (o EN_PROCESO).
+        """
+        sync_ids = list(dict.fromkeys(sync_ids))
+        if not sync_ids: return {}
+        tabla = self.supabase.table("sync_idempotencia")
+        tabla.delete().in_("sync_id", sync_ids).lt("expires_at", self._vence(0)).execute()
+        filas = [{"sync_id": i, "resultado": self.EN_PROCESO, "expires_at": self._vence(self.ttl_en_proceso)} for i in sync_ids]
+        res = tabla.upsert(filas, on_conflict="sync_id", ignore_duplicates=True).execute()
+        reservados = {f.get('sync_id') for f in res.data or []}
+        otros = [i for i in sync_ids if i not in reservados]
+        previos = {}
+        if otros:
+            for fila in tabla.select("sync_id, resultado").in_("sync_id", otros).execute().data or []:
+                previos[fila['sync_id']] = dict(fila.get('resultado') or self.EN_PROCESO)
+            for i in otros: previos.setdefault(i, dict(self.EN_PROCESO))
+        return previos
+
+    def reservar(self, sync_id):
+        """Marca el syncId como en proceso. Si ya existía retorna su resultado (o EN_PROCESO)."""
+        return self.reservar_lote([sync_id]).get(sync_id)
+
+    def guardar_lote(self, resultados):
+        if not resultados: return
+        filas = [{"sync_id": i, "resultado": r, "expires_at": self._vence(self.ttl)} for i, r in resultados.items()]
+        self.supabase.table("sync_idempotencia").upsert(filas, on_conflict="sync_id").execute()
+
+    def guardar(self, sync_id, resultado):
+        self.guardar_lote({sync_id: dict(resultado)})
+
+    def liberar_lote(self, sync_ids):
+        if not sync_ids: return
+        self.supabase.table("sync_idempotencia").delete().in_("sync_id", list(sync_ids)).execute()
+
+    def liberar(self, sync_id):
+        self.liberar_lote([sync_id])
+
+class ColaBorradoDrive:
+    """
+    Borrado diferido de carpetas de Drive a partir de las lápidas con drive_pendiente
+    (sql/prospectos_eliminados.sql). La cola vive en la BD: sobrevive a reinicios y la comparten
+    todos los workers, que toman cada lápida con un update condicional antes de procesarla.
+    """
+
+    def __init__(self, supabase, sheets):
+        self.supabase = supabase
+        self.sheets = sheets
+        self._despertar = threading.Event()
+        threading.Thread(target=self._ciclo, name="ColaBorradoDrive", daemon=True).start()
+
+    def _fecha(self, segundos=0):
+        return (datetime.utcnow() + timedelta(seconds=segundos)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def encolar(self):
+        """Avisa al hilo de que hay lápidas nuevas para no esperar al siguiente sondeo."""
+        self._despertar.set()
+
+    def pendientes(self):
+        try:
+            res = self.supabase.table("prospectos_eliminados").select("id", count='exact').eq("drive_pendiente", True).limit(1).execute()
+            return res.count
+        except Exception as e:
+            logger.error(f"BORRADO DRIVE: No se pudo contar pendientes -> {e}")
+            return None
+
+    def _ciclo(self):
+        while True:
+            procesados = 0
+            try:
+                procesados = self.procesar_pendientes()
+            except Exception as e:
+                logger.error(f"BORRADO DRIVE ERROR: {e}")
+            if not procesados:
+                self._despertar.wait(BORRADO_DRIVE_SONDEO)
+                self._despertar.clear()
+
+    def procesar_pendientes(self):
+        """Procesa las lápidas vencidas que este worker logre tomar. Retorna cuántas tomó."""
+        tabla = self.supabase.table
+        tomadas = 0
+        filas = tabla("prospectos_eliminados").select("id, imagenes_url, drive_intentos, drive_proximo_intento") \
+            .eq("drive_pendiente", True).lte("drive_proximo_intento", self._fecha()) \
+            .order("drive_proximo_intento").limit(20).execute().data or []
+        for fila in filas:
+            # Se toma la lápida aplazando su próximo intento; si otro worker la tomó antes no se devuelve
+            tomada = tabla("prospectos_eliminados").update({"drive_proximo_intento": self._fecha(BORRADO_DRIVE_TOMA)}) \
+                .eq("id", fila['id']).eq("drive_pendiente", True).eq("drive_proximo_intento", fila['drive_proximo_intento']).execute()
+            if not tomada.data: continue
+            tomadas += 1
+            res = self.sheets.borrar_carpeta_drive(fila.get('imagenes_url'))
+            intento = (fila.get('drive_intentos') or 0) + 1
+            if (res or {}).get('status') != 'error':
+                cambios = {"drive_pendiente": False, "drive_intentos": intento, "drive_error": None}
+            elif intento >= BORRADO_DRIVE_REINTENTOS:
+                logger.error(f"BORRADO DRIVE: Se agotaron los reintentos para {fila.get('imagenes_url')}")
+                cambios = {"drive_pendiente": False, "drive_intentos": intento, "drive_error": "Reintentos agotados."}
+            else:
+                cambios = {"drive_intentos": intento, "drive_error": str((res or {}).get('message') or 'error'),
+                           "drive_proximo_intento": self._fecha(BORRADO_DRIVE_ESPERA * 2 ** (intento - 1))}
+            tabla("prospectos_eliminados").update(cambios).eq("id", fila['id']).execute()
+        return tomadas
+
+class PoolListo:
+    """
+    Cola en memoria de leads candidatos del Pool, mantenida por un hilo de fondo.
+    El reparto entre asesoras se hace en BD (asignado_a / asignado_hasta en AGENDA_OBSOLETA)
+    con actualizaciones condicionales, de modo que todos los workers de Gunicorn entregan lotes disjuntos.
+    """
+
+    def __init__(self, data_handler):
+        self.dh = data_handler
+        self._lock = threading.Lock()
+        self._rellenar = threading.Event()
+        self._cola = OrderedDict()   # folio_i -> fila candidata
+        self._ocupados = {}          # folio_i -> timestamp hasta el que otra asesora lo tiene asignado
+        self._retirados = set()      # folios retirados mientras corre un rellenado
+        self._cargado = False
+        self._hilo = None
+
+    def iniciar(self):
+        if self._hilo and self._hilo.is_alive(): return
+        self._hilo = threading.Thread(target=self._ciclo, name="PoolListo", daemon=True)
+        self._hilo.start()
+
+    def _ciclo(self):
+        while True:
+            try:
+                self.refrescar()
+            except Exception as e:
+                logger.error(f"POOL LISTO ERROR: {e}")
+            self._rellenar.wait(POOL_LISTO_INTERVALO)
+            self._rellenar.clear()
+
+    def refrescar(self):
+        """
+        Escanea AGENDA_OBSOLETA con las reglas de get_pool_clients y reemplaza la cola de candidatos.
+        Se omiten los leads con asignación vigente para que la cola solo tenga lo que aún se puede repartir.
+        """
+        tz_mex = pytz.timezone('America/Mexico_City')
+        now_mx = datetime.now(tz_mex)
+        ahora_iso = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        with self._lock:
+            self._retirados = set()
+
+        libres = OrderedDict()
+        offset, limit = 0, 200
+        while len(libres) < POOL_LISTO_TAMANO:
+            res = self.dh.supabase.table("AGENDA_OBSOLETA").select(POOL_COLUMNAS) \
+                .or_(f"asignado_hasta.is.null,asignado_hasta.lt.{ahora_iso}") \
+                .order("updated_at", desc=True).range(offset, offset + limit - 1).execute()
+            if not res.data: break
+            for item in res.data:
+                if not self.dh._evaluar_lead_pool(item, now_mx): continue
+                if str(item.get('status') or '').startswith('BLOQUEADO_'): continue
+                libres[item.get('folio_i')] = self.dh._fila_pool(item)
+                if len(libres) == POOL_LISTO_TAMANO: break
+            if len(res.data) < limit: break
+            offset += limit
+
+        with self._lock:
+            for folio in self._retirados: libres.pop(folio, None)
+            self._cola = libres
+            ahora = time.time()
+            self._ocupados = {f: hasta for f, hasta in self._ocupados.items() if f in libres and hasta > ahora}
+            self._cargado = True
+        logger.info(f"POOL LISTO: {len(libres)} candidatos en cola.")
+
+    def obtener(self, asesora):
+        """
+        Reclamados de la asesora + su lote exclusivo de libres. None si la cola aún no está cargada.
+        1. Renueva en BD las asignaciones vigentes de la asesora (visibles desde cualquier worker).
+        2. Completa el lote asignando candidatos con un update condicional (estado libre y sin asignación vigente).
+        Ambos updates exigen estado libre: un lead que otro worker ya apartó no se asigna ni se renueva.
+        """
+        with self._lock:
+            if not self._cargado: return None
+        tabla = self.dh.supabase.table
+        ahora = datetime.utcnow()
+        ahora_iso = ahora.strftime('%Y-%m-%dT%H:%M:%SZ')
+        hasta_iso = (ahora + timedelta(seconds=POOL_LISTO_RESERVA)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        reclamados = tabla("AGENDA_OBSOLETA").select(POOL_COLUMNAS).eq("status", f"BLOQUEADO_{asesora}").execute().data or []
+        propios = tabla("AGENDA_OBSOLETA").update({"asignado_hasta": hasta_iso}) \
+            .eq("asignado_a", asesora).gt("asignado_hasta", ahora_iso).or_(POOL_FILTRO_LIBRE).execute().data or []
+
+        for _ in range(3):
+            faltan = POOL_LISTO_POR_ASESORA - len(propios)
+            if faltan <= 0: break
+            tomados = {f.get('folio_i') for f in propios}
+            with self._lock:
+                marca = time.time()
+                candidatos = [f for f in self._cola if f not in tomados and self._ocupados.get(f, 0) <= marca][:faltan]
+            if not candidatos: break
+            asignados = tabla("AGENDA_OBSOLETA").update({"asignado_a": asesora, "asignado_hasta": hasta_iso}) \
+                .in_("folio_i", candidatos) \
+                .or_(f"and(or({POOL_FILTRO_LIBRE}),or(asignado_hasta.is.null,asignado_hasta.lt.{ahora_iso}))").execute().data or []
+            obtenidos = {f.get('folio_i') for f in asignados}
+            with self._lock:
+                for folio in candidatos:
+                    # No devuelto: otra asesora lo tiene asignado o ya no está libre
+                    if folio not in obtenidos: self._ocupados[folio] = marca + POOL_LISTO_RESERVA
+            propios.extend(asignados)
+
+        with self._lock:
+            if len(self._cola) < POOL_LISTO_MINIMO: self._rellenar.set()
+        return [self.dh._fila_pool(f) for f in reclamados] + [self.dh._fila_pool(f) for f in propios]
+
+    def solicitar_rellenado(self):
+        self._rellenar.set()
+
+    def retirar(self, folio):
+        """Elimina el lead de la cola local (apartado, resuelto o ya no libre)."""
+        with self._lock:
+            self._cola.pop(folio, None)
+            self._ocupados.pop(folio, None)
+            self._retirados.add(folio)
+            if len(self._cola) < POOL_LISTO_MINIMO: self._rellenar.set()
+
 class DataHandler:
     """
     Gestor de persistencia v4.0.
@@ -99,6 +389,20 @@ class DataHandler:
         key = os.getenv("SUPABASE_KEY") or SUPABASE_KEY
         self.supabase: Client = create_client(url, key)
         self.sheets = GoogleSheetsSync()
+        # Caché LRU de expedientes completos (prospecto + seguimientos) indexada por p_id, con TTL
+        self._perfil_cache = OrderedDict()
+        self._perfil_lock = threading.Lock()
+        # Reconciliación periódica de los contadores del panel de auditoría (resumen_dashboard)
+        threading.Thread(target=self._ciclo_resumen, name="ResumenDashboard", daemon=True).start()
+        # Carpetas de Drive pendientes de borrar tras eliminar prospectos
+        self.borrado_drive = ColaBorradoDrive(self.supabase, self.sheets)
+        # syncId ya procesados de la cola offline del frontend
+        self.idempotencia = AlmacenIdempotencia(self.supabase)
+        # Cola de leads del Pool mantenida en segundo plano
+        self.pool_listo = PoolListo(self)
+        self.pool_listo.iniciar()
+        # Barrido periódico de apartados BLOQUEADO_ vencidos
+        threading.Thread(target=self._ciclo_barrido, name="BarridoReservas", daemon=True).start()
         logger.info("DATA HANDLER v4.0: Servicios de Calendario habilitados.")
 
     def _normalize(self, text):
@@ -160,6 +464,34 @@ class DataHandler:
             return date_obj.strftime("%d/%m/%Y")
         except: return fecha_db
 
+    def _payload_registro(self, datos, canal_num, drive_url=""):
+        """Construye la fila de 'prospectos' para un alta con la URL de evidencia ya resuelta (o vacía)."""
+        tz_mex = pytz.timezone('America/Mexico_City')
+        fecha_prox = datos.get('Fecha Próx. Contacto')
+        rendimiento = "Sin Cita"
+        if fecha_prox and fecha_prox != '--':
+            try:
+                fp = datetime.strptime(str(fecha_prox), "%d/%m/%Y").date()
+                now_mx = datetime.now(tz_mex).date()
+                if fp >= now_mx: rendimiento = "AL DIA"
+                else: rendimiento = "VENCIDO"
+            except: pass
+        
+        payload = {
+            "canal": canal_num, 
+            "nombre": datos.get('Nombre'),
+            "nivel_interes": datos.get('Nivel de Interés'), 
+            "resumen": datos.get('Resumen Conversación'),
+            "estado_final": datos.get('Estado Final'), 
+            "asesora": datos.get('Asesora'),
+            "fecha_registro": self._formatear_fecha_sql(datos.get('Fecha 1er Contacto')),
+            "fecha_proxima": self._formatear_fecha_sql(datos.get('Fecha Próx. Contacto')),
+            "imagenes_url": drive_url, 
+            "updated_at": datetime.now(tz_mex).isoformat(),
+            "rendimiento": rendimiento
+        }
+        return payload
+
     def registrar_prospecto(self, datos):
         """
         Registra prospecto con validación preventiva.
@@ -188,31 +520,7 @@ class DataHandler:
                 nombre_archivo = f"Registro - {files[0]['name']}"
                 res_drive = self.sheets.subir_evidencia_drive(datos.get('Nombre'), files[0]['base64Data'], nombre_archivo)
                 drive_url = res_drive.get('folderUrl', "")
-            
-            tz_mex = pytz.timezone('America/Mexico_City')
-            fecha_prox = datos.get('Fecha Próx. Contacto')
-            rendimiento = "Sin Cita"
-            if fecha_prox and fecha_prox != '--':
-                try:
-                    fp = datetime.strptime(str(fecha_prox), "%d/%m/%Y").date()
-                    now_mx = datetime.now(tz_mex).date()
-                    if fp >= now_mx: rendimiento = "AL DIA"
-                    else: rendimiento = "VENCIDO"
-                except: pass
-            
-            payload = {
-                "canal": canal_num, 
-                "nombre": datos.get('Nombre'),
-                "nivel_interes": datos.get('Nivel de Interés'), 
-                "resumen": datos.get('Resumen Conversación'),
-                "estado_final": datos.get('Estado Final'), 
-                "asesora": datos.get('Asesora'),
-                "fecha_registro": self._formatear_fecha_sql(datos.get('Fecha 1er Contacto')),
-                "fecha_proxima": self._formatear_fecha_sql(datos.get('Fecha Próx. Contacto')),
-                "imagenes_url": drive_url, 
-                "updated_at": datetime.now(tz_mex).isoformat(),
-                "rendimiento": rendimiento
-            }
+            payload = self._payload_registro(datos, canal_num, drive_url)
             
             self.supabase.table("prospectos").insert(payload).execute()
             logger.info(f"REGISTRO EXITOSO: {datos.get('Nombre')} ({canal_num})")
@@ -225,7 +533,7 @@ class DataHandler:
             logger.error(f"FALLO REGISTRO: {err_str}")
             return {"status": "error", "message": err_str}
 
-    def subir_evidencia_fondo(self, nombre_original, files_payload, num_seg, p_id):
+    def subir_evidencia_fondo(self, nombre_original, files_payload, num_seg, p_id, prefijo=None):
         """
         Método asíncrono para subir archivos a Google Drive.
         Evita que las conexiones desde Google Chrome (Mac) se corten por Timeouts.
@@ -234,90 +542,316 @@ class DataHandler:
         try:
             if files_payload:
                 logger.info(f"HILO FONDO: Iniciando subida de Drive para '{nombre_original}'")
-                nombre_archivo = f"Seguimiento {num_seg} - {files_payload[0]['name']}"
+                nombre_archivo = f"{prefijo or f'Seguimiento {num_seg}'} - {files_payload[0]['name']}"
                 res_drive = self.sheets.subir_evidencia_drive(nombre_original, files_payload[0]['base64Data'], nombre_archivo)
                 
                 if res_drive and res_drive.get('folderUrl'):
                     # Si exitoso, actualizamos solo la URL de imagen en el registro prospecto
-                    self.supabase.table("prospectos").update({"imagenes_url": res_drive.get('folderUrl')}).eq("id", p_id).execute()
+                    # updated_at cambia para que los demás workers descarten su copia en caché
+                    self.supabase.table("prospectos").update({
+                        "imagenes_url": res_drive.get('folderUrl'),
+                        "updated_at": datetime.now(pytz.timezone('America/Mexico_City')).isoformat()
+                    }).eq("id", p_id).execute()
+                    self._invalidar_perfil(p_id)
                     logger.info(f"HILO FONDO OK: Imagen guardada en BD para '{nombre_original}'")
                 else:
                     logger.warning(f"HILO FONDO: Subida falló o sin URL para '{nombre_original}'")
         except Exception as e:
             logger.error(f"HILO FONDO ERROR: No se subió archivo para '{nombre_original}' -> {e}")
 
+    def _preparar_actualizacion(self, p_row, updates):
+        """
+        A partir de la fila actual del prospecto construye el payload maestro y los seguimientos a insertar.
+        Retorna (maestro_payload, seg_payloads, num_seg) o un dict de error si el registro está cerrado.
+        """
+        p_id = p_row.get('id')
+        estado_actual = p_row.get('estado_final')
+        if estado_actual in ["Venta", "No interesado"]:
+            return {"status": "error", "message": f"Seguridad: El prospecto ya está como '{estado_actual}' y no puede ser modificado."}
+        
+        p_canal = p_row['canal']
+        fecha_ant_db = p_row.get('fecha_proxima')
+        fecha_ant_str = self._formatear_fecha_ui(fecha_ant_db) if fecha_ant_db else "Sin cita previa"
+        
+        tz_mex = pytz.timezone('America/Mexico_City')
+        now_mx = datetime.now(tz_mex).date()
+        rendimiento_str = "Sin Cita"
+        if fecha_ant_db:
+            try:
+                date_db = datetime.strptime(str(fecha_ant_db), "%Y-%m-%d").date()
+                diff = (now_mx - date_db).days
+                if diff <= 0: rendimiento_str = "AL DIA"
+                elif diff == 1: rendimiento_str = "ALERTA"
+                else: rendimiento_str = "VENCIDO"
+            except: pass
+        
+        num_seg = "Gral"
+        for k in updates.keys():
+            if "Notas Seguimiento" in k:
+                try: num_seg = k.split(" ")[-1]; break
+                except: pass
+                
+        maestro_payload = {
+            "estado_final": updates.get('Estado Final'), "nivel_interes": updates.get('Nivel de Interés'),
+            "fecha_proxima": self._formatear_fecha_sql(updates.get('Fecha Próx. Contacto')),
+            "comentarios": updates.get('Comentarios'), "updated_at": datetime.now(tz_mex).isoformat(),
+            "rendimiento": rendimiento_str
+        }
+        
+        seg_payloads = []
+        for key, val in updates.items():
+            if "Notas Seguimiento" in key and val:
+                try: num_paso = int(key.split(" ")[-1])
+                except:
+                    logger.warning(f"Seguimiento ignorado para prospecto {p_id}: clave inválida '{key}'")
+                    continue
+                fecha_seg = updates.get(f"Fecha Seguimiento {num_paso}")
+                nota_modificada = f"Cita anterior programada: {fecha_ant_str}\n{val}"
+                seg_payloads.append({
+                    "prospecto_id": p_id, "prospecto_canal": p_canal,
+                    "numero_paso": num_paso, "fecha_seguimiento": self._formatear_fecha_sql(fecha_seg),
+                    "nota_seguimiento": nota_modificada, "created_at": datetime.now(tz_mex).isoformat()
+                })
+        return maestro_payload, seg_payloads, num_seg
+
     def actualizar_prospecto_avanzado(self, p_id, updates, files_payload=None):
         try:
-            p_res = self.supabase.table("prospectos").select("id, canal, fecha_proxima, estado_final").eq("id", p_id).execute()
+            p_res = self.supabase.table("prospectos").select(SELECT_ACTUALIZACION).eq("id", p_id).execute()
             if not p_res.data: return {"status": "error", "message": "Registro no encontrado usando ID principal."}
             
-            estado_actual = p_res.data[0].get('estado_final')
-            if estado_actual in ["Venta", "No interesado"]:
-                return {"status": "error", "message": f"Seguridad: El prospecto ya está como '{estado_actual}' y no puede ser modificado."}
-            
-            p_canal = p_res.data[0]['canal']
-            fecha_ant_db = p_res.data[0].get('fecha_proxima')
-            fecha_ant_str = self._formatear_fecha_ui(fecha_ant_db) if fecha_ant_db else "Sin cita previa"
-            
-            tz_mex = pytz.timezone('America/Mexico_City')
-            now_mx = datetime.now(tz_mex).date()
-            rendimiento_str = "Sin Cita"
-            if fecha_ant_db:
-                try:
-                    date_db = datetime.strptime(str(fecha_ant_db), "%Y-%m-%d").date()
-                    diff = (now_mx - date_db).days
-                    if diff <= 0: rendimiento_str = "AL DIA"
-                    elif diff == 1: rendimiento_str = "ALERTA"
-                    else: rendimiento_str = "VENCIDO"
-                except: pass
+            preparado = self._preparar_actualizacion(p_res.data[0], updates)
+            if isinstance(preparado, dict): return preparado
+            maestro_payload, seg_payloads, num_seg = preparado
             
-            num_seg = "Gral"
-            for k in updates.keys():
-                if "Notas Seguimiento" in k:
-                    try: num_seg = k.split(" ")[-1]; break
-                    except: pass
-                    
-            maestro_payload = {
-                "estado_final": updates.get('Estado Final'), "nivel_interes": updates.get('Nivel de Interés'),
-                "fecha_proxima": self._formatear_fecha_sql(updates.get('Fecha Próx. Contacto')),
-                "comentarios": updates.get('Comentarios'), "updated_at": datetime.now(tz_mex).isoformat(),
-                "rendimiento": rendimiento_str
-            }
             # Se ha removido la lógica síncrona de subida de Drive aquí, favoreciendo la BD
             self.supabase.table("prospectos").update(maestro_payload).eq("id", p_id).execute()
             
-            for key, val in updates.items():
-                if "Notas Seguimiento" in key and val:
-                    try:
-                        num_paso = int(key.split(" ")[-1])
-                        fecha_seg = updates.get(f"Fecha Seguimiento {num_paso}")
-                        nota_modificada = f"Cita anterior programada: {fecha_ant_str}\n{val}"
-                        seg_payload = {
-                            "prospecto_id": p_id, "prospecto_canal": p_canal,
-                            "numero_paso": num_paso, "fecha_seguimiento": self._formatear_fecha_sql(fecha_seg),
-                            "nota_seguimiento": nota_modificada, "created_at": datetime.now(tz_mex).isoformat()
-                        }
-                        self.supabase.table("seguimientos").insert(seg_payload).execute()
-                    except Exception as e:
-                        logger.error(f"Fallo al insertar seguimiento #{num_paso} para prospecto {p_id}: {e}")
-                        return {"status": "error", "message": f"Fallo al registrar seguimiento #{num_paso}. Puede que ya exista o haya conflicto."}
+            for seg_payload in seg_payloads:
+                num_paso = seg_payload['numero_paso']
+                try:
+                    self.supabase.table("seguimientos").insert(seg_payload).execute()
+                except Exception as e:
+                    logger.error(f"Fallo al insertar seguimiento #{num_paso} para prospecto {p_id}: {e}")
+                    self._invalidar_perfil(p_id)
+                    return {"status": "error", "message": f"Fallo al registrar seguimiento #{num_paso}. Puede que ya exista o haya conflicto."}
             
+            self._invalidar_perfil(p_id)
             # Retornamos p_id y num_seg para que si se requiere subida a drive, el app.py tenga la información necesaria
             return {"status": "success", "message": "Expediente sincronizado.", "p_id": p_id, "num_seg": num_seg}
         except Exception as e: return {"status": "error", "message": str(e)}
 
+    # --- SINCRONIZACIÓN POR LOTES (COLA OFFLINE) ---
+    def _tipo_sync(self, item):
+        endpoint = str(item.get('endpoint') or item.get('tipo') or '')
+        if endpoint.endswith('add-client') or endpoint == 'alta': return 'alta'
+        if endpoint.endswith('update-client-advanced') or endpoint == 'actualizacion': return 'actualizacion'
+        return None
+
+    def sincronizar_lote(self, items):
+        """
+        Procesa la cola offline completa del frontend en una sola petición.
+        Cada elemento es {syncId, endpoint, payload}. Los syncId ya procesados se responden
+        desde el almacén de idempotencia sin repetir Supabase/Drive.
+        Retorna la lista de resultados en el mismo orden, cada uno con su syncId.
+        """
+        resultados = [None] * len(items)
+        altas, cambios = [], []
+        sync_ids = [item.get('syncId') or (item.get('payload') or {}).get('sync_id') for item in items]
+        try:
+            previos = self.idempotencia.reservar_lote([i for i in sync_ids if i])
+        except Exception as e:
+            logger.error(f"IDEMPOTENCIA ERROR: {e}")
+            return [{"status": "error", "message": "Almacén de idempotencia no disponible.", **({"syncId": i} if i else {})} for i in sync_ids]
+        vistos = set()
+        for idx, item in enumerate(items):
+            payload = item.get('payload') or {}
+            sync_id = sync_ids[idx]
+            if sync_id:
+                # Repetido dentro del mismo lote: solo se procesa la primera aparición
+                previo = previos.get(sync_id) or (AlmacenIdempotencia.EN_PROCESO if sync_id in vistos else None)
+                vistos.add(sync_id)
+                if previo is not None:
+                    resultados[idx] = dict(previo, replay=True)
+                    continue
+            tipo = self._tipo_sync(item)
+            if tipo == 'alta': altas.append((idx, payload))
+            elif tipo == 'actualizacion': cambios.append((idx, payload))
+            else: resultados[idx] = {"status": "error", "message": "Tipo de operación desconocido."}
+
+        if altas: self._sincronizar_altas(altas, resultados)
+        if cambios: self._sincronizar_cambios(cambios, resultados)
+
+        definitivos, liberar = {}, []
+        for idx, sync_id in enumerate(sync_ids):
+            res = resultados[idx]
+            if not sync_id: continue
+            res['syncId'] = sync_id
+            if res.get('replay'): continue
+            # Solo se memorizan resultados definitivos; los errores se liberan para reintento
+            if res.get('status') in ['success', 'duplicate']:
+                definitivos[sync_id] = {k: v for k, v in res.items() if k not in ['p_id', 'num_seg', 'syncId']}
+            else:
+                liberar.append(sync_id)
+        try:
+            self.idempotencia.guardar_lote(definitivos)
+            self.idempotencia.liberar_lote(liberar)
+        except Exception as e:
+            logger.error(f"IDEMPOTENCIA ERROR: No se registraron los resultados del lote -> {e}")
+        return resultados
+
+    def _sincronizar_altas(self, altas, resultados):
+        """
+        Altas del lote: una consulta de duplicados y un único insert (con respaldo fila por fila).
+        La evidencia NO se sube aquí: cada resultado exitoso lleva su p_id y app.py la sube en segundo plano.
+        """
+        duplicado = {"status": "duplicate", "message": "El número que se intenta registrar ya pertenece a otra persona."}
+        canales = {}
+        for idx, datos in altas:
+            canal_num = self._limpiar_canal(datos.get('Canal'))
+            if not canal_num: resultados[idx] = {"status": "error", "message": "Canal inválido."}
+            else: canales[idx] = canal_num
+        if not canales: return
+        try:
+            check = self.supabase.table("prospectos").select("canal").in_("canal", list(set(canales.values()))).execute()
+            existentes = {row.get('canal') for row in check.data or []}
+        except Exception as e:
+            for idx in canales: resultados[idx] = {"status": "error", "message": str(e)}
+            return
+
+        pendientes = []
+        for idx, datos in altas:
+            if idx not in canales: continue
+            canal_num = canales[idx]
+            if canal_num in existentes:
+                logger.warning(f"REGISTRO DESCARTADO: El número {canal_num} ya existe en la base de datos.")
+                resultados[idx] = dict(duplicado)
+                continue
+            existentes.add(canal_num)
+            try: pendientes.append((idx, self._payload_registro(datos, canal_num)))  # imagenes_url se completa al subir
+            except Exception as e: resultados[idx] = {"status": "error", "message": str(e)}
+        if not pendientes: return
+
+        try:
+            res = self.supabase.table("prospectos").insert([payload for _, payload in pendientes]).execute()
+            ids = {row.get('canal'): row.get('id') for row in res.data or []}
+            for idx, payload in pendientes:
+                resultados[idx] = {"status": "success", "message": "Prospecto registrado correctamente.", "p_id": ids.get(payload['canal'])}
+            logger.info(f"REGISTRO LOTE: {len(pendientes)} prospectos insertados.")
+        except Exception as e:
+            logger.warning(f"REGISTRO LOTE: insert masivo falló ({e}), reintentando fila por fila.")
+            for idx, payload in pendientes:
+                try:
+                    res = self.supabase.table("prospectos").insert(payload).execute()
+                    resultados[idx] = {"status": "success", "message": "Prospecto registrado correctamente.", "p_id": (res.data or [{}])[0].get('id')}
+                except Exception as err:
+                    err_str = str(err)
+                    if "23505" in err_str or "duplicate key" in err_str.lower(): resultados[idx] = dict(duplicado)
+                    else: resultados[idx] = {"status": "error", "message": err_str}
+
+    def _sincronizar_cambios(self, cambios, resultados):
+        """Actualizaciones del lote: una lectura de prospectos y un único insert de seguimientos."""
+        ids = list({str(payload.get('p_id')) for _, payload in cambios if payload.get('p_id')})
+        filas = {}
+        if ids:
+            try:
+                p_res = self.supabase.table("prospectos").select(SELECT_ACTUALIZACION).in_("id", ids).execute()
+                filas = {str(row.get('id')): row for row in p_res.data or []}
+            except Exception as e:
+                for idx, _ in cambios: resultados[idx] = {"status": "error", "message": str(e)}
+                return
+
+        segs_por_idx = {}
+        for idx, payload in cambios:
+            p_id = payload.get('p_id')
+            if not p_id:
+                resultados[idx] = {"status": "error", "message": "Se requiere el identificador único (p_id)."}
+                continue
+            fila = filas.get(str(p_id))
+            if not fila:
+                resultados[idx] = {"status": "error", "message": "Registro no encontrado usando ID principal."}
+                continue
+            try:
+                preparado = self._preparar_actualizacion(fila, payload.get('updates') or {})
+                if isinstance(preparado, dict):
+                    resultados[idx] = preparado
+                    continue
+                maestro_payload, seg_payloads, num_seg = preparado
+                self.supabase.table("prospectos").update(maestro_payload).eq("id", p_id).execute()
+                # Los siguientes cambios del mismo prospecto en el lote parten del estado recién escrito
+                fila.update(maestro_payload)
+                segs_por_idx[idx] = seg_payloads
+                resultados[idx] = {"status": "success", "message": "Expediente sincronizado.", "p_id": p_id, "num_seg": num_seg}
+            except Exception as e:
+                resultados[idx] = {"status": "error", "message": str(e)}
+            self._invalidar_perfil(p_id)
+
+        todos = [seg for segs in segs_por_idx.values() for seg in segs]
+        if not todos: return
+        try:
+            self.supabase.table("seguimientos").insert(todos).execute()
+        except Exception as e:
+            logger.warning(f"SEGUIMIENTOS LOTE: insert masivo falló ({e}), reintentando por prospecto.")
+            for idx, segs in segs_por_idx.items():
+                for seg_payload in segs:
+                    try:
+                        self.supabase.table("seguimientos").insert(seg_payload).execute()
+                    except Exception as err:
+                        num_paso = seg_payload['numero_paso']
+                        logger.error(f"Fallo al insertar seguimiento #{num_paso} para prospecto {seg_payload['prospecto_id']}: {err}")
+                        resultados[idx] = {"status": "error", "message": f"Fallo al registrar seguimiento #{num_paso}. Puede que ya exista o haya conflicto."}
+                        break
+        for segs in segs_por_idx.values():
+            if segs: self._invalidar_perfil(segs[0]['prospecto_id'])
+
+    def _eliminar_por_canales(self, canales, eliminado_por=None, imagenes_url=None):
+        """
+        Borra los prospectos de los canales dados por lotes con la función eliminar_prospectos,
+        que en la misma transacción inserta sus lápidas (con drive_pendiente) en 'prospectos_eliminados'.
+        Cada lote invalida caché y avisa a la cola de Drive justo después de su borrado.
+        Retorna (lápidas de las filas eliminadas, canales cuyo lote falló).
+        """
+        eliminados, fallidos = [], []
+        for i in range(0, len(canales), BORRADO_LOTE):
+            lote = canales[i:i + BORRADO_LOTE]
+            try:
+                res = self.supabase.rpc("eliminar_prospectos", {"p_canales": lote, "p_eliminado_por": eliminado_por, "p_imagenes_url": imagenes_url}).execute()
+            except Exception as e:
+                logger.error(f"BORRADO LOTE ERROR: {len(lote)} canales sin borrar -> {e}")
+                fallidos.extend(lote)
+                continue
+            lapidas = res.data or []
+            eliminados.extend(lapidas)
+            for lapida in lapidas: self._invalidar_perfil(lapida.get('prospecto_id'))
+            if any(l.get('drive_pendiente') for l in lapidas): self.borrado_drive.encolar()
+        return eliminados, fallidos
+
     def delete_client_db(self, name, canal, imagenes_url=None):
         canal_limpio = self._limpiar_canal(canal)
+        if not canal_limpio: return False, "Canal inválido."
         try:
-            url_final = imagenes_url
-            if not url_final:
-                res = self.supabase.table("prospectos").select("imagenes_url").eq("canal", canal_limpio).execute()
-                if res.data: url_final = res.data[0].get('imagenes_url')
-            if url_final: self.sheets.borrar_carpeta_drive(url_final)
-            self.supabase.table("prospectos").delete().eq("canal", canal_limpio).execute()
+            _, fallidos = self._eliminar_por_canales([canal_limpio], imagenes_url=imagenes_url)
+            if fallidos: return False, "No se pudo borrar el registro."
             return True, "Borrado con éxito."
         except Exception as e: return False, str(e)
 
+    def delete_clients_bulk(self, canales, eliminado_por=None):
+        """
+        Borrado masivo de prospectos; las carpetas de Drive se limpian en segundo plano.
+        Si algún lote falla se responde 'partial' con lo eliminado y los canales pendientes de reintento.
+        """
+        limpios = list(dict.fromkeys(c for c in (self._limpiar_canal(x) for x in canales or []) if c))
+        if not limpios: return {"status": "error", "message": "No se recibieron canales válidos."}
+        eliminados, fallidos = self._eliminar_por_canales(limpios, eliminado_por)
+        borrados = {fila.get('canal') for fila in eliminados}
+        logger.info(f"BORRADO MASIVO: {len(borrados)} de {len(limpios)} canales eliminados, {len(fallidos)} fallidos.")
+        status = "success" if not fallidos else ("partial" if borrados else "error")
+        return {
+            "status": status, "eliminados": len(borrados),
+            "no_encontrados": [c for c in limpios if c not in borrados and c not in fallidos],
+            "fallidos": fallidos,
+            "drive_pendientes": self.borrado_drive.pendientes()
+        }
+
     def get_all_clients(self):
         if not self.supabase: return []
         all_data = []
@@ -336,22 +870,82 @@ class DataHandler:
             return all_data
         except: return []
 
+    # --- CACHÉ DE EXPEDIENTES ---
+    def _cache_perfil_get(self, p_id):
+        key = str(p_id)
+        with self._perfil_lock:
+            entrada = self._perfil_cache.get(key)
+            if entrada is None: return None
+            guardado_en, perfil = entrada
+            if time.time() - guardado_en > PERFIL_CACHE_TTL:
+                self._perfil_cache.pop(key, None)
+                return None
+            self._perfil_cache.move_to_end(key)
+            return dict(perfil)
+
+    def _cache_perfil_set(self, perfil):
+        key = str(perfil.get('id'))
+        with self._perfil_lock:
+            self._perfil_cache[key] = (time.time(), dict(perfil))
+            self._perfil_cache.move_to_end(key)
+            while len(self._perfil_cache) > PERFIL_CACHE_MAX:
+                self._perfil_cache.popitem(last=False)
+
+    def _invalidar_perfil(self, p_id):
+        """Descarta del caché el expediente por p_id."""
+        with self._perfil_lock:
+            self._perfil_cache.pop(str(p_id), None)
+
     def get_client_full_profile(self, p_id):
+        """
+        Expediente de un solo prospecto. Siempre se lee de la BD: es el que abre la tarjeta y de él
+        sale el siguiente numero_paso, así que no puede venir de la copia de otro worker.
+        """
         try:
             res = self.supabase.table("prospectos").select("*, seguimientos!seguimientos_prospecto_id_fkey(*)").eq("id", p_id).execute()
             if not res.data: return None
-            return self._reconstruir_objeto_prospecto(res.data[0])
+            perfil = self._reconstruir_objeto_prospecto(res.data[0])
+            self._cache_perfil_set(perfil)
+            return dict(perfil)
         except: return None
 
-    def _reconstruir_objeto_prospecto(self, p):
-        p['id_db'] = p.get('id')
-        p['nombre'] = p.get('nombre') or "Sin Nombre"
-        p['fecha_registro'] = self._formatear_fecha_ui(p.get('fecha_registro'))
-        
-        fp_db = p.get('fecha_proxima')
-        p['fecha_proxima'] = self._formatear_fecha_ui(fp_db)
-        
-        rend = p.get('rendimiento')
+    def get_clients_full_profiles(self, ids):
+        """
+        Versión por lotes de get_client_full_profile.
+        Resuelve desde caché lo que siga vigente (mismo updated_at en BD) y trae el resto (con sus seguimientos) en una sola consulta.
+        Retorna la lista de expedientes en el orden solicitado, omitiendo los inexistentes.
+        """
+        orden = list(dict.fromkeys(str(p_id) for p_id in ids))
+        perfiles = {}
+        for key in orden:
+            perfil = self._cache_perfil_get(key)
+            if perfil is not None: perfiles[key] = perfil
+        if perfiles:
+            # Otro worker pudo modificar el expediente: solo se sirve la copia si updated_at no cambió
+            try:
+                res = self.supabase.table("prospectos").select("id, updated_at").in_("id", list(perfiles)).execute()
+                vigentes = {str(f['id']): f.get('updated_at') for f in res.data or []}
+            except Exception as e:
+                logger.error(f"PERFILES LOTE ERROR: {e}")
+                vigentes = {}
+            for key in list(perfiles):
+                if key not in vigentes or vigentes[key] != perfiles[key].get('updated_at'):
+                    perfiles.pop(key)
+                    self._invalidar_perfil(key)
+        faltantes = [key for key in orden if key not in perfiles]
+        if faltantes:
+            try:
+                res = self.supabase.table("prospectos").select("*, seguimientos!seguimientos_prospecto_id_fkey(*)").in_("id", faltantes).execute()
+                for item in res.data or []:
+                    perfil = self._reconstruir_objeto_prospecto(item)
+                    self._cache_perfil_set(perfil)
+                    perfiles[str(perfil.get('id'))] = dict(perfil)
+            except Exception as e:
+                logger.error(f"PERFILES LOTE ERROR: {e}")
+        return [perfiles[key] for key in orden if key in perfiles]
+
+    def _rendimiento_efectivo(self, rend, fp_db):
+        """Rendimiento guardado o, si no hay, calculado a partir de fecha_proxima (formato BD)."""
         if not rend or rend == "Sin Cita":
             rend = "Sin Cita"
             if fp_db:
@@ -363,7 +957,56 @@ class DataHandler:
                     elif diff == 1: rend = "ALERTA"
                     else: rend = "VENCIDO"
                 except: pass
-        p['rendimiento'] = rend
+        return rend
+
+    def reconciliar_resumen(self):
+        """
+        Recalcula resumen_dashboard desde 'prospectos' (sql/resumen_dashboard.sql).
+        Los ajustes incrementales los hace el trigger de la tabla; esto corrige el rendimiento calculado por fecha.
+        """
+        try:
+            res = self.supabase.rpc("reconciliar_resumen_dashboard", {"p_intervalo_seg": RESUMEN_INTERVALO}).execute()
+            if res.data: logger.info("RESUMEN DASHBOARD: Contadores reconciliados.")
+        except Exception as e:
+            logger.error(f"RESUMEN DASHBOARD ERROR: {e}")
+
+    def _ciclo_resumen(self):
+        # Se consulta con más frecuencia que el intervalo; la BD decide qué worker reconcilia
+        while True:
+            self.reconciliar_resumen()
+            time.sleep(RESUMEN_INTERVALO / 5)
+
+    def get_stats(self, asesora=None):
+        """Conteos por asesora y globales a partir de resumen_dashboard (unas decenas de filas)."""
+        try:
+            query = self.supabase.table("resumen_dashboard").select("asesora, campo, valor, conteo").gt("conteo", 0)
+            if asesora: query = query.eq("asesora", asesora)
+            filas = query.execute().data or []
+            turno = self.supabase.table("tareas_programadas").select("ultima_ejecucion").eq("nombre", "resumen_dashboard").execute().data
+        except Exception as e:
+            logger.error(f"STATS ERROR: {e}")
+            return {"status": "error", "message": str(e)}
+        asesoras = {}
+        total = {"total": 0, **{campo: {} for campo in RESUMEN_CAMPOS}}
+        for fila in filas:
+            bloque = asesoras.setdefault(fila['asesora'], {"total": 0, **{campo: {} for campo in RESUMEN_CAMPOS}})
+            if fila['campo'] == 'total':
+                bloque["total"] = fila['conteo']
+                total["total"] += fila['conteo']
+            elif fila['campo'] in RESUMEN_CAMPOS:
+                bloque[fila['campo']][fila['valor']] = fila['conteo']
+                total[fila['campo']][fila['valor']] = total[fila['campo']].get(fila['valor'], 0) + fila['conteo']
+        return {"asesoras": asesoras, "global": total, "actualizado": turno[0].get('ultima_ejecucion') if turno else None}
+
+    def _reconstruir_objeto_prospecto(self, p):
+        p['id_db'] = p.get('id')
+        p['nombre'] = p.get('nombre') or "Sin Nombre"
+        p['fecha_registro'] = self._formatear_fecha_ui(p.get('fecha_registro'))
+        
+        fp_db = p.get('fecha_proxima')
+        p['fecha_proxima'] = self._formatear_fecha_ui(fp_db)
+        
+        p['rendimiento'] = self._rendimiento_efectivo(p.get('rendimiento'), fp_db)
         
         if 'imagenes_url' in p:
             p['Imagenes'] = p.get('imagenes_url') or ""
@@ -377,6 +1020,25 @@ class DataHandler:
         p.pop('seguimientos', None); p.pop('seguimientos!seguimientos_prospecto_id_fkey', None)
         return p
 
+    def compactar_prospecto(self, p):
+        """
+        Esquema compacto de un prospecto ya reconstruido: sin alias duplicados (id_db, Imagenes),
+        sin valores nulos y con los seguimientos en un arreglo anidado.
+        """
+        compacto = {}
+        seguimientos = {}
+        for k, v in p.items():
+            if v is None or k in ['id_db', 'Imagenes']: continue
+            m = re.match(r'^(fecha|notas)_seguimiento_(\d+)$', k)
+            if m:
+                seg = seguimientos.setdefault(int(m.group(2)), {"paso": int(m.group(2))})
+                seg["fecha" if m.group(1) == 'fecha' else "nota"] = v
+                continue
+            compacto[k] = v
+        if seguimientos:
+            compacto['seguimientos'] = [seguimientos[n] for n in sorted(seguimientos)]
+        return compacto
+
     def login_asesora(self, nombre):
         """Valida el acceso de la asesora comparando con la pestaña AsesorasActivas."""
         if not nombre: return {"status": "error", "message": "Nombre requerido."}
@@ -437,6 +1099,55 @@ class DataHandler:
         except: return []
 
     # --- INICIO MÓDULO POOL ---
+    def _evaluar_lead_pool(self, item, now_mx):
+        """
+        Reglas de elegibilidad del Pool para una fila de AGENDA_OBSOLETA.
+        Libres/NSH con 3 días o más de antigüedad y cualquier BLOQUEADO_ (para "Mis Reclamados").
+        """
+        st = item.get('status') or ''
+        valid = False
+        
+        if st in ['', 'NSH', 'LIBRE'] or st is None:
+            # 2. EVALUACIÓN DE ANTIGÜEDAD (Regla 3 días usando la columna 'fecha')
+            fecha_str = item.get('fecha')
+            
+            if fecha_str:
+                try:
+                    # Parsear la fecha soportando formatos convencionales YYYY-MM-DD o DD/MM/YYYY
+                    fecha_str_clean = str(fecha_str).strip()[:10]
+                    if '-' in fecha_str_clean:
+                        dt_fecha = datetime.strptime(fecha_str_clean, "%Y-%m-%d").date()
+                    elif '/' in fecha_str_clean:
+                        dt_fecha = datetime.strptime(fecha_str_clean, "%d/%m/%Y").date()
+                    else:
+                        dt_fecha = now_mx.date() # Fallback
+                        
+                    # 3. Calcular la diferencia exacta de días contra el hoy en CDMX
+                    diff_days = (now_mx.date() - dt_fecha).days
+                    
+                    # Si tiene 3 días o más de antigüedad, se libera al Pool público
+                    if diff_days >= 3:
+                        valid = True
+                except Exception as e:
+                    valid = False
+                    
+        elif st.startswith('BLOQUEADO_'):
+            # Siempre debe ser True para que el registro viaje al frontend y aparezca en Mis Reclamados.
+            # Los apartados vencidos ya los libera en BD liberar_reservas_vencidas.
+            valid = True
+        return valid
+
+    def _fila_pool(self, item):
+        return {
+            "folio_i": item.get('folio_i'),
+            "telefono": item.get('telefono'),
+            "status": item.get('status'),
+            "hora": item.get('hora'),
+            "fecha": item.get('fecha'),
+            "updated": item.get('updated'),
+            "updated_at": item.get('updated_at')
+        }
+
     def get_pool_clients(self):
         try:
             # 1. Establecer hora actual en base a timezone local
@@ -449,62 +1160,12 @@ class DataHandler:
             
             # Se hace el query sin created_at para evitar el error column AGENDA_OBSOLETA.created_at does not exist
             while True:
-                res = self.supabase.table("AGENDA_OBSOLETA").select("folio_i, telefono, status, hora, fecha, updated, updated_at").order("updated_at", desc=True).range(offset, offset + limit - 1).execute()
+                res = self.supabase.table("AGENDA_OBSOLETA").select(POOL_COLUMNAS).order("updated_at", desc=True).range(offset, offset + limit - 1).execute()
                 if not res.data: break
                 
                 for item in res.data:
-                    st = item.get('status') or ''
-                    valid = False
-                    
-                    if st in ['', 'NSH', 'LIBRE'] or st is None:
-                        # 2. EVALUACIÓN DE ANTIGÜEDAD (Regla 3 días usando la columna 'fecha')
-                        fecha_str = item.get('fecha')
-                        
-                        if fecha_str:
-                            try:
-                                # Parsear la fecha soportando formatos convencionales YYYY-MM-DD o DD/MM/YYYY
-                                fecha_str_clean = str(fecha_str).strip()[:10]
-                                if '-' in fecha_str_clean:
-                                    dt_fecha = datetime.strptime(fecha_str_clean, "%Y-%m-%d").date()
-                                elif '/' in fecha_str_clean:
-                                    dt_fecha = datetime.strptime(fecha_str_clean, "%d/%m/%Y").date()
-                                else:
-                                    dt_fecha = now_mx.date() # Fallback
-                                    
-                                # 3. Calcular la diferencia exacta de días contra el hoy en CDMX
-                                diff_days = (now_mx.date() - dt_fecha).days
-                                
-                                # Si tiene 3 días o más de antigüedad, se libera al Pool público
-                                if diff_days >= 3:
-                                    valid = True
-                            except Exception as e:
-                                valid = False
-                                
-                    elif st.startswith('BLOQUEADO_'):
-                        # Siempre debe ser True para que el registro viaje al frontend y aparezca en Mis Reclamados
-                        valid = True
-                        up = item.get('updated_at')
-                        if up:
-                            try:
-                                dt = datetime.fromisoformat(str(up).replace('Z', '+00:00'))
-                                if not dt.tzinfo:
-                                    dt = tz_mex.localize(dt)
-                                diff = (now_mx - dt).days
-                                if diff > 5:
-                                    # Si el apartado caducó, se modifica temporalmente el status a vacío 
-                                    item['status'] = ''
-                            except: pass
-                            
-                    if valid:
-                        pool.append({
-                            "folio_i": item.get('folio_i'),
-                            "telefono": item.get('telefono'),
-                            "status": item.get('status'),
-                            "hora": item.get('hora'),
-                            "fecha": item.get('fecha'),
-                            "updated": item.get('updated'),
-                            "updated_at": item.get('updated_at')
-                        })
+                    if self._evaluar_lead_pool(item, now_mx):
+                        pool.append(self._fila_pool(item))
                         
                         # Detener el ciclo si ya logramos 10 prospectos válidos
                         if len(pool) == 10:
@@ -518,6 +1179,16 @@ class DataHandler:
             logger.error(f"Error GET POOL: {str(e)}")
             return []
 
+    def get_pool_for_agent(self, asesora_nombre):
+        """
+        Pool servido desde la cola de candidatos: los reclamados de la asesora más un lote exclusivo
+        de libres asignado en BD.
+        Mientras la cola aún no se ha cargado por primera vez se usa el escaneo directo.
+        """
+        pool = self.pool_listo.obtener(asesora_nombre)
+        if pool is None: return self.get_pool_clients()
+        return pool
+
     def take_pool_client(self, lead_id, asesora_nombre):
         try:
             tz_mex = pytz.timezone('America/Mexico_City')
@@ -526,38 +1197,71 @@ class DataHandler:
             if limit_check.data and len(limit_check.data) >= 10:
                 return {"status": "error", "message": "Límite de 10 prospectos alcanzado.", "code": 403}
                 
-            lead_check = self.supabase.table("AGENDA_OBSOLETA").select("status, updated_at").eq("folio_i", lead_id).execute()
+            lead_check = self.supabase.table("AGENDA_OBSOLETA").select("status").eq("folio_i", lead_id).execute()
             if not lead_check.data:
                 return {"status": "error", "message": "No encontrado", "code": 404}
             
+            # Los BLOQUEADO_ vencidos ya fueron liberados por el barrido periódico
             st = lead_check.data[0].get('status') or ''
-            up = lead_check.data[0].get('updated_at')
-            available = False
-            if st in ['', 'NSH'] or st is None:
-                available = True
-            elif st.startswith('BLOQUEADO_'):
-                if up:
-                    try:
-                        dt = datetime.fromisoformat(str(up).replace('Z', '+00:00'))
-                        if not dt.tzinfo:
-                            dt = tz_mex.localize(dt)
-                        if (now_mx - dt).days > 5:
-                            available = True
-                    except: pass
+            available = st in ['', 'NSH']
             
             if not available:
+                self.pool_listo.retirar(lead_id)
                 return {"status": "error", "message": "El prospecto ya fue tomado", "code": 409}
                 
-            self.supabase.table("AGENDA_OBSOLETA").update({
+            # Solo se aparta si sigue libre y no está asignado a otra asesora (asignación vencida, inexistente o propia);
+            # ambas condiciones van en el filtro del update para que dos asesoras no aparten el mismo lead
+            ahora_iso = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+            asesora_filtro = '"' + str(asesora_nombre).replace('\\', '\\\\').replace('"', '\\"') + '"'
+            estado_filtro = 'status.is.null,status.in.("",NSH)'
+            res = self.supabase.table("AGENDA_OBSOLETA").update({
                 "status": f"BLOQUEADO_{asesora_nombre}",
                 "updated": True,
-                "updated_at": now_mx.isoformat()
-            }).eq("folio_i", lead_id).execute()
+                "updated_at": now_mx.isoformat(),
+                "asignado_a": None,
+                "asignado_hasta": None
+            }).eq("folio_i", lead_id) \
+                .or_(f"and(or({estado_filtro}),or(asignado_hasta.is.null,asignado_hasta.lt.{ahora_iso},asignado_a.eq.{asesora_filtro}))").execute()
+            self.pool_listo.retirar(lead_id)
+            if not res.data:
+                return {"status": "error", "message": "El prospecto ya fue tomado o está asignado a otra asesora", "code": 409}
             
             return {"status": "success"}
         except Exception as e:
             return {"status": "error", "message": str(e), "code": 500}
 
+    def liberar_reservas_vencidas(self):
+        """
+        Barrido masivo: la función barrer_reservas_vencidas (sql/barrido_reservas.sql) libera en una sola
+        actualización todos los BLOQUEADO_ vencidos y acumula la ejecución en barrido_reservas_totales.
+        Solo un worker toma el turno por intervalo; los demás reciben None.
+        """
+        try:
+            res = self.supabase.rpc("barrer_reservas_vencidas", {"p_dias": BARRIDO_DIAS, "p_intervalo_seg": BARRIDO_INTERVALO}).execute()
+            liberados = res.data
+            if liberados:
+                logger.info(f"BARRIDO POOL: {liberados} apartados vencidos liberados.")
+                self.pool_listo.solicitar_rellenado()
+            return liberados
+        except Exception as e:
+            logger.error(f"BARRIDO POOL ERROR: {e}")
+            return None
+
+    def get_barrido_metricas(self):
+        """Métricas compartidas desde la vista barrido_reservas_resumen (iguales sin importar el worker que responda)."""
+        try:
+            res = self.supabase.table("barrido_reservas_resumen").select("*").execute()
+            return res.data[0] if res.data else {}
+        except Exception as e:
+            logger.error(f"BARRIDO MÉTRICAS ERROR: {e}")
+            return {"status": "error", "message": str(e)}
+
+    def _ciclo_barrido(self):
+        # Se consulta con más frecuencia que el intervalo; la BD decide qué worker ejecuta
+        while True:
+            self.liberar_reservas_vencidas()
+            time.sleep(BARRIDO_INTERVALO / 5)
+
     def resolve_pool_client(self, lead_id, asesora_nombre, accion, datos_validacion):
         try:
             tz_mex = pytz.timezone('America/Mexico_City')
@@ -576,8 +1280,11 @@ class DataHandler:
             self.supabase.table("AGENDA_OBSOLETA").update({
                 "status": new_status,
                 "updated": True,
-                "updated_at": now_mx.isoformat()
+                "updated_at": now_mx.isoformat(),
+                "asignado_a": None,
+                "asignado_hasta": None
             }).eq("folio_i", lead_id).execute()
+            self.pool_listo.retirar(lead_id)
             return {"status": "success"}
         except Exception as e:
             return {"status": "error", "message": str(e), "code": 500}
@@ -0,0 +1,83 @@
+-- Turnos de tareas periódicas compartidas entre workers: solo quien toma el turno ejecuta la tarea.
+create table if not exists tareas_programadas (
+    nombre text primary key,
+    ultima_ejecucion timestamptz not null
+);
+
+create or replace function tomar_turno_tarea(p_nombre text, p_intervalo_seg integer)
+returns boolean language plpgsql as $$
+declare
+    tomado boolean;
+begin
+    insert into tareas_programadas (nombre, ultima_ejecucion) values (p_nombre, now())
+    on conflict (nombre) do update set ultima_ejecucion = now()
+        where tareas_programadas.ultima_ejecucion < now() - make_interval(secs => p_intervalo_seg)
+    returning true into tomado;
+    return coalesce(tomado, false);
+end $$;
+
+-- Totales acumulados de barridos de apartados BLOQUEADO_ vencidos (métricas compartidas).
+-- Una sola fila que se actualiza en cada barrido, así la consulta de métricas no crece con el tiempo.
+create table if not exists barrido_reservas_totales (
+    id smallint primary key default 1 check (id = 1),
+    ejecuciones bigint not null default 0,
+    liberados_total bigint not null default 0,
+    ultimo_liberados integer,
+    ultima_ejecucion timestamptz,
+    ultima_duracion_ms integer
+);
+
+insert into barrido_reservas_totales (id) values (1) on conflict (id) do nothing;
+
+-- Migración desde la bitácora anterior (una fila por barrido): se conservan sus totales y se elimina.
+do $$
+begin
+    if to_regclass('barrido_reservas_log') is not null then
+        update barrido_reservas_totales t
+           set ejecuciones = t.ejecuciones + l.ejecuciones,
+               liberados_total = t.liberados_total + l.liberados_total,
+               ultimo_liberados = coalesce(t.ultimo_liberados, l.ultimo_liberados),
+               ultima_ejecucion = coalesce(t.ultima_ejecucion, l.ultima_ejecucion),
+               ultima_duracion_ms = coalesce(t.ultima_duracion_ms, l.ultima_duracion_ms)
+          from (select count(*) as ejecuciones, coalesce(sum(liberados), 0) as liberados_total,
+                       (array_agg(liberados order by ejecutado_en desc))[1] as ultimo_liberados,
+                       max(ejecutado_en) as ultima_ejecucion,
+                       (array_agg(duracion_ms order by ejecutado_en desc))[1] as ultima_duracion_ms
+                  from barrido_reservas_log) l
+         where t.id = 1;
+        drop view if exists barrido_reservas_resumen;
+        drop table barrido_reservas_log;
+    end if;
+end $$;
+
+-- Libera en una sola actualización los BLOQUEADO_ con más de p_dias y acumula cuántos liberó.
+-- Retorna null si otro worker ya ejecutó el barrido en este intervalo.
+create or replace function barrer_reservas_vencidas(p_dias integer, p_intervalo_seg integer)
+returns integer language plpgsql as $$
+declare
+    inicio timestamptz := clock_timestamp();
+    total integer;
+begin
+    if not tomar_turno_tarea('barrido_reservas', p_intervalo_seg) then
+        return null;
+    end if;
+    update "AGENDA_OBSOLETA"
+       set status = '', updated = true, updated_at = now()
+     where status like 'BLOQUEADO\_%' and updated_at < now() - make_interval(days => p_dias);
+    get diagnostics total = row_count;
+    update barrido_reservas_totales
+       set ejecuciones = ejecuciones + 1,
+           liberados_total = liberados_total + total,
+           ultimo_liberados = total,
+           ultima_ejecucion = now(),
+           ultima_duracion_ms = (extract(epoch from clock_timestamp() - inicio) * 1000)::integer
+     where id = 1;
+    return total;
+end $$;
+
+-- Totales para /api/pool/sweeper-metrics (lectura de una sola fila).
+drop view if exists barrido_reservas_resumen;
+create view barrido_reservas_resumen as
+select ejecuciones, liberados_total, ultimo_liberados, ultima_ejecucion, ultima_duracion_ms
+  from barrido_reservas_totales
+ where id = 1;
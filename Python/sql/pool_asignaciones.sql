@@ -0,0 +1,8 @@
+-- Asignación compartida de leads del Pool entre workers (PoolListo / take_pool_client).
+-- Un lead entregado a una asesora queda reservado hasta asignado_hasta; se libera al apartarlo o resolverlo.
+alter table "AGENDA_OBSOLETA"
+    add column if not exists asignado_a text,
+    add column if not exists asignado_hasta timestamptz;
+
+create index if not exists agenda_obsoleta_asignado_idx
+    on "AGENDA_OBSOLETA" (asignado_a, asignado_hasta);
@@ -0,0 +1,40 @@
+-- Lápidas de prospectos eliminados y cola durable de borrado de carpetas de Drive.
+-- El borrado y la lápida se hacen en la misma transacción (eliminar_prospectos), así que ninguna
+-- carpeta queda huérfana si el worker se reinicia: ColaBorradoDrive drena las filas con drive_pendiente.
+create table if not exists prospectos_eliminados (
+    id bigserial primary key,
+    prospecto_id bigint,
+    canal bigint,
+    nombre text,
+    asesora text,
+    imagenes_url text,
+    datos jsonb not null,
+    eliminado_por text,
+    deleted_at timestamptz not null default now(),
+    drive_pendiente boolean not null default false,
+    drive_intentos integer not null default 0,
+    drive_proximo_intento timestamptz,
+    drive_error text
+);
+
+create index if not exists prospectos_eliminados_canal_idx on prospectos_eliminados (canal);
+create index if not exists prospectos_eliminados_drive_idx
+    on prospectos_eliminados (drive_proximo_intento) where drive_pendiente;
+
+-- Borra los prospectos de p_canales y devuelve sus lápidas (una por fila borrada).
+-- p_imagenes_url se usa como carpeta cuando la fila no tiene imagenes_url (borrado individual desde el panel).
+create or replace function eliminar_prospectos(p_canales bigint[], p_eliminado_por text default null, p_imagenes_url text default null)
+returns setof prospectos_eliminados language sql as $$
+    with borrados as (
+        delete from prospectos where canal = any(p_canales) returning *
+    )
+    insert into prospectos_eliminados
+        (prospecto_id, canal, nombre, asesora, imagenes_url, datos, eliminado_por, drive_pendiente, drive_proximo_intento)
+    select b.id, b.canal, b.nombre, b.asesora,
+           coalesce(nullif(b.imagenes_url, ''), p_imagenes_url),
+           to_jsonb(b), p_eliminado_por,
+           coalesce(nullif(b.imagenes_url, ''), p_imagenes_url) is not null,
+           now()
+      from borrados b
+    returning *
+$$;
@@ -0,0 +1,78 @@
+-- Contadores del panel de auditoría (/api/stats), compartidos por todos los workers.
+-- Un trigger sobre prospectos los ajusta en la misma transacción de cada alta, cambio o borrado;
+-- reconciliar_resumen_dashboard los recalcula periódicamente (el rendimiento calculado cambia con los días).
+-- Requiere tomar_turno_tarea (sql/barrido_reservas.sql).
+create table if not exists resumen_dashboard (
+    asesora text not null,
+    campo text not null,
+    valor text not null,
+    conteo integer not null default 0,
+    primary key (asesora, campo, valor)
+);
+
+-- Misma regla que DataHandler._rendimiento_efectivo.
+create or replace function rendimiento_efectivo(p_rend text, p_fecha text)
+returns text language sql stable as $$
+    select case
+        when coalesce(p_rend, '') not in ('', 'Sin Cita') then p_rend
+        when p_fecha is null or p_fecha !~ '^\d{4}-\d{2}-\d{2}' then 'Sin Cita'
+        when (now() at time zone 'America/Mexico_City')::date - substr(p_fecha, 1, 10)::date <= 0 then 'AL DIA'
+        when (now() at time zone 'America/Mexico_City')::date - substr(p_fecha, 1, 10)::date = 1 then 'ALERTA'
+        else 'VENCIDO'
+    end
+$$;
+
+create or replace function ajustar_resumen_dashboard(p_asesora text, p_estado text, p_interes text, p_rend text, p_delta integer)
+returns void language sql as $$
+    insert into resumen_dashboard (asesora, campo, valor, conteo)
+    values (coalesce(nullif(p_asesora, ''), 'Sin Asesora'), 'total', 'total', p_delta),
+           (coalesce(nullif(p_asesora, ''), 'Sin Asesora'), 'estado_final', coalesce(nullif(p_estado, ''), 'Sin Dato'), p_delta),
+           (coalesce(nullif(p_asesora, ''), 'Sin Asesora'), 'nivel_interes', coalesce(nullif(p_interes, ''), 'Sin Dato'), p_delta),
+           (coalesce(nullif(p_asesora, ''), 'Sin Asesora'), 'rendimiento', coalesce(nullif(p_rend, ''), 'Sin Dato'), p_delta)
+    on conflict (asesora, campo, valor) do update set conteo = resumen_dashboard.conteo + excluded.conteo
+$$;
+
+create or replace function trg_resumen_dashboard()
+returns trigger language plpgsql as $$
+begin
+    if tg_op in ('UPDATE', 'DELETE') then
+        perform ajustar_resumen_dashboard(old.asesora, old.estado_final, old.nivel_interes,
+            rendimiento_efectivo(old.rendimiento, old.fecha_proxima::text), -1);
+    end if;
+    if tg_op in ('INSERT', 'UPDATE') then
+        perform ajustar_resumen_dashboard(new.asesora, new.estado_final, new.nivel_interes,
+            rendimiento_efectivo(new.rendimiento, new.fecha_proxima::text), 1);
+    end if;
+    return null;
+end $$;
+
+drop trigger if exists prospectos_resumen_dashboard on prospectos;
+create trigger prospectos_resumen_dashboard
+    after insert or delete or update of asesora, estado_final, nivel_interes, rendimiento, fecha_proxima
+    on prospectos for each row execute function trg_resumen_dashboard();
+
+-- Recalcula todo desde prospectos bloqueando escrituras durante el recálculo (ningún ajuste se pierde).
+-- Solo un worker toma el turno por intervalo; retorna false si no le tocó.
+create or replace function reconciliar_resumen_dashboard(p_intervalo_seg integer)
+returns boolean language plpgsql as $$
+begin
+    if not tomar_turno_tarea('resumen_dashboard', p_intervalo_seg) then
+        return false;
+    end if;
+    lock table prospectos in share mode;
+    delete from resumen_dashboard;
+    insert into resumen_dashboard (asesora, campo, valor, conteo)
+    select asesora, campo, valor, count(*)
+      from (
+        select coalesce(nullif(p.asesora, ''), 'Sin Asesora') as asesora, x.campo, x.valor
+          from prospectos p
+          cross join lateral (values
+              ('total', 'total'),
+              ('estado_final', coalesce(nullif(p.estado_final, ''), 'Sin Dato')),
+              ('nivel_interes', coalesce(nullif(p.nivel_interes, ''), 'Sin Dato')),
+              ('rendimiento', rendimiento_efectivo(p.rendimiento, p.fecha_proxima::text))
+          ) as x(campo, valor)
+      ) t
+     group by asesora, campo, valor;
+    return true;
+end $$;
@@ -0,0 +1,24 @@
+-- Almacén compartido de idempotencia para la cola offline (/api/sync-batch y endpoints individuales).
+-- Una fila por syncId: resultado 'processing' mientras se procesa y el resultado definitivo después.
+create table if not exists sync_idempotencia (
+    sync_id text primary key,
+    resultado jsonb not null,
+    expires_at timestamptz not null
+);
+
+create index if not exists sync_idempotencia_expires_idx on sync_idempotencia (expires_at);
+
+-- Borra los syncId vencidos. Solo un worker toma el turno por intervalo (tomar_turno_tarea,
+-- sql/barrido_reservas.sql); retorna null si otro worker ya purgó en este intervalo.
+create or replace function purgar_sync_idempotencia(p_intervalo_seg integer)
+returns integer language plpgsql as $$
+declare
+    total integer;
+begin
+    if not tomar_turno_tarea('purga_sync_idempotencia', p_intervalo_seg) then
+        return null;
+    end if;
+    delete from sync_idempotencia where expires_at < now();
+    get diagnostics total = row_count;
+    return total;
+end $$;